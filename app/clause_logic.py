@@ -1,5 +1,31 @@
 import re
-from typing import List
+from typing import List, Tuple
+
+import numpy as np
+
+
+def score_clause(chunk: str, question: str, parsed_query: dict) -> float:
+    """
+    Scores a chunk by the structured fields (age, procedure, location, policy_duration)
+    of the parsed query it contains, plus keyword overlap with the question.
+    """
+    pq = parsed_query or {}
+    chunk_lower = chunk.lower()
+    score = 0
+    # Score by presence of structured fields
+    if pq.get("age") and pq["age"] in chunk:
+        score += 1
+    if pq.get("procedure") and pq["procedure"].lower() in chunk_lower:
+        score += 2
+    if pq.get("location") and pq["location"].lower() in chunk_lower:
+        score += 1
+    if pq.get("policy_duration") and pq["policy_duration"].lower() in chunk_lower:
+        score += 1
+    # Also score by keyword overlap with question
+    for word in question.split():
+        if word.lower() in chunk_lower:
+            score += 0.2
+    return score
 
 
 def match_clauses(text_chunks: List[str], questions: List[str], parsed_queries: List[dict]) -> List[str]:
@@ -13,20 +39,7 @@ def match_clauses(text_chunks: List[str], questions: List[str], parsed_queries:
         best_score = 0
         best_chunk = None
         for chunk in text_chunks:
-            score = 0
-            # Score by presence of structured fields
-            if pq.get("age") and pq["age"] in chunk:
-                score += 1
-            if pq.get("procedure") and pq["procedure"].lower() in chunk.lower():
-                score += 2
-            if pq.get("location") and pq["location"].lower() in chunk.lower():
-                score += 1
-            if pq.get("policy_duration") and pq["policy_duration"].lower() in chunk.lower():
-                score += 1
-            # Also score by keyword overlap with question
-            for word in question.split():
-                if word.lower() in chunk.lower():
-                    score += 0.2
+            score = score_clause(chunk, question, pq)
             if score > best_score:
                 best_score = score
                 best_chunk = chunk
@@ -36,4 +49,49 @@ def match_clauses(text_chunks: List[str], questions: List[str], parsed_queries:
             answers.append("Clause not found in document.")
     return answers
 
+
+def rerank_chunks(
+    question: str,
+    question_embedding: List[float],
+    chunks: List[str],
+    chunk_embeddings: List[List[float]],
+    parsed_query: dict,
+    top_n: int = 5,
+    mmr_lambda: float = 0.7,
+    field_weight: float = 0.2,
+) -> List[Tuple[str, float]]:
+    """
+    Maximal-marginal-relevance re-ranking over embeddings we already have.
+    Relevance is cosine similarity to the question plus the normalised score_clause
+    signal; redundancy is the highest cosine similarity to an already selected chunk.
+    Returns up to top_n (chunk, score) pairs in selection order.
+    """
+    if not chunks:
+        return []
+    q = np.asarray(question_embedding, dtype=np.float32)
+    embs = np.asarray(chunk_embeddings, dtype=np.float32)
+    q = q / (np.linalg.norm(q) or 1.0)
+    norms = np.linalg.norm(embs, axis=1, keepdims=True)
+    embs = embs / np.where(norms == 0, 1.0, norms)
+
+    relevance = embs @ q
+    field_scores = np.array([score_clause(c, question, parsed_query) for c in chunks], dtype=np.float32)
+    if field_scores.max() > 0:
+        relevance = relevance + field_weight * field_scores / field_scores.max()
+
+    similarity = embs @ embs.T
+    max_sim_to_selected = np.zeros(len(chunks), dtype=np.float32)
+    available = np.ones(len(chunks), dtype=bool)
+    selected = []
+    for step in range(min(top_n, len(chunks))):
+        mmr = mmr_lambda * relevance
+        if step:
+            mmr = mmr - (1 - mmr_lambda) * max_sim_to_selected
+        mmr = np.where(available, mmr, -np.inf)
+        best = int(np.argmax(mmr))
+        selected.append((chunks[best], float(mmr[best])))
+        available[best] = False
+        max_sim_to_selected = np.maximum(max_sim_to_selected, similarity[:, best])
+    return selected
+
 # Add more advanced logic evaluation as needed for domain-specific scenarios
@@ -6,25 +6,335 @@ import asyncio
 import PyPDF2
 from docx import Document
 import tempfile
+import re
+import zipfile
+import hashlib
+import json
+import shutil
+import collections
+import urllib.parse
 from email import policy
 from email.parser import BytesParser
 
+# Download settings, tunable via env vars
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+DOWNLOAD_RANGE_CHUNK = int(os.getenv("DOWNLOAD_RANGE_CHUNK", str(4 * 1024 * 1024)))
+DOWNLOAD_RANGE_WORKERS = int(os.getenv("DOWNLOAD_RANGE_WORKERS", "4"))
+DOWNLOAD_CACHE_DIR = os.getenv("DOWNLOAD_CACHE_DIR", os.path.join(tempfile.gettempdir(), "docqa-download-cache"))
+DOWNLOAD_CACHE_MAX_BYTES = int(os.getenv("DOWNLOAD_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Process-wide pooled clients, so repeated fetches from the same storage
+# account reuse connections instead of paying a new TLS handshake each time.
+_session = requests.Session()
+_async_client = None
+
+def get_async_client():
+    """Returns the shared httpx.AsyncClient, creating it on first use."""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        try:
+            import h2  # noqa: F401  (HTTP/2 support is optional)
+            http2 = True
+        except ImportError:
+            http2 = False
+        _async_client = httpx.AsyncClient(
+            timeout=60,
+            http2=http2,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        )
+    return _async_client
+
+async def close_async_client():
+    """Closes the shared httpx.AsyncClient (call on application shutdown)."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+def _check_size(size, url):
+    if DOWNLOAD_MAX_BYTES and size > DOWNLOAD_MAX_BYTES:
+        raise ValueError(f"File at {url} exceeds the maximum download size of {DOWNLOAD_MAX_BYTES} bytes")
+
+# Local content cache: <cache_dir>/<sha256(url)> holds the body and
+# <sha256(url)>.json holds the validators (ETag / Last-Modified), the digest
+# and the Content-Type of the body, plus the normalised URL it belongs to.
+# The key is the full URL minus the Azure SAS signing parameters, so the same
+# blob fetched with different SAS tokens shares one entry while any other
+# query parameter still identifies a different resource. Entries are evicted
+# least-recently-used first once DOWNLOAD_CACHE_MAX_BYTES is exceeded.
+SAS_QUERY_PARAMS = {"sv", "ss", "srt", "sp", "se", "st", "spr", "sig", "sr", "si", "sdd",
+                    "skoid", "sktid", "skt", "ske", "sks", "skv", "saoid", "suoid", "scid",
+                    "rscc", "rscd", "rsce", "rscl", "rsct"}
+
+def _cache_url(url):
+    parsed = urllib.parse.urlsplit(url)
+    query = [(name, value) for name, value in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+             if name.lower() not in SAS_QUERY_PARAMS]
+    return urllib.parse.urlunsplit((parsed.scheme, parsed.netloc, parsed.path,
+                                    urllib.parse.urlencode(query), ""))
+
+def _cache_paths(url):
+    key = hashlib.sha256(_cache_url(url).encode("utf-8")).hexdigest()
+    return os.path.join(DOWNLOAD_CACHE_DIR, key), os.path.join(DOWNLOAD_CACHE_DIR, f"{key}.json")
+
+def _cache_enabled():
+    return bool(DOWNLOAD_CACHE_DIR) and DOWNLOAD_CACHE_MAX_BYTES > 0
+
+def _load_cache_entry(url):
+    if not _cache_enabled():
+        return None
+    body_path, meta_path = _cache_paths(url)
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("url") != _cache_url(url) or not meta.get("sha256") or not os.path.exists(body_path):
+        return None
+    return meta
+
+def _conditional_headers(meta):
+    headers = {}
+    if meta:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+def _file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def _link_or_copy(src, dst):
+    """
+    Atomically places the contents of src at dst: hard-links (or copies, across
+    filesystems) into a temp file next to dst, then os.replace()s it in.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst), prefix=".tmp-")
+    os.close(fd)
+    try:
+        try:
+            os.remove(tmp_path)
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _write_json_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _evict_cache_entries():
+    """Removes least-recently-used entries until the cache fits its byte budget."""
+    entries = []
+    for name in os.listdir(DOWNLOAD_CACHE_DIR):
+        if name.startswith(".") or name.endswith(".json"):
+            continue
+        try:
+            st = os.stat(os.path.join(DOWNLOAD_CACHE_DIR, name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= DOWNLOAD_CACHE_MAX_BYTES:
+            break
+        for path in (os.path.join(DOWNLOAD_CACHE_DIR, name), os.path.join(DOWNLOAD_CACHE_DIR, f"{name}.json")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+
+def _store_cache_entry(url, filename, response_headers, digest, content_type):
+    etag = response_headers.get("ETag")
+    last_modified = response_headers.get("Last-Modified")
+    if not _cache_enabled() or not (etag or last_modified):
+        return
+    try:
+        if os.path.getsize(filename) > DOWNLOAD_CACHE_MAX_BYTES:
+            return
+        body_path, meta_path = _cache_paths(url)
+        os.makedirs(DOWNLOAD_CACHE_DIR, exist_ok=True)
+        # Body first, then meta: a reader that sees new meta with an old body
+        # (or vice versa) fails the sha256 check in _restore_cache_entry.
+        _link_or_copy(filename, body_path)
+        _write_json_atomic(meta_path, {"url": _cache_url(url), "etag": etag, "last_modified": last_modified,
+                                       "sha256": digest, "content_type": content_type})
+        _evict_cache_entries()
+    except OSError:
+        pass  # The cache is best-effort
+
+def _restore_cache_entry(url, filename, meta):
+    """
+    Copies a cached body to filename after checking it against the stored
+    sha256. Returns (digest, content_type), or None if the entry is unusable.
+    """
+    body_path, meta_path = _cache_paths(url)
+    try:
+        _link_or_copy(body_path, filename)
+        if _file_sha256(filename) != meta["sha256"]:
+            for path in (body_path, meta_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return None
+        os.utime(body_path)  # Mark as recently used for eviction
+    except OSError:
+        return None
+    return meta["sha256"], meta.get("content_type")
+
 # Download any file
 
 def download_file(url, filename):
-    """Synchronous file download (legacy)"""
-    response = requests.get(url)
-    with open(filename, 'wb') as f:
-        f.write(response.content)
+    """
+    Synchronous streaming file download (legacy). Enforces DOWNLOAD_MAX_BYTES
+    and returns the sha256 hex digest and Content-Type of the body.
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    with _session.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        _check_size(int(response.headers.get("Content-Length", 0)), url)
+        content_type = response.headers.get("Content-Type")
+        with open(filename, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                _check_size(size, url)
+                hasher.update(chunk)
+                f.write(chunk)
+    return hasher.hexdigest(), content_type
+
+def _parse_content_range_total(value):
+    # "bytes 0-4194303/12345678" -> 12345678 (None if the total is unknown)
+    if not value or "/" not in value:
+        return None
+    total = value.rsplit("/", 1)[1].strip()
+    return int(total) if total.isdigit() else None
+
+def _check_identity_encoding(response, url):
+    # Ranges are byte offsets into the stored representation; a content-coded
+    # body cannot be stitched together at those offsets.
+    if response.headers.get("Content-Encoding", "identity").lower() != "identity":
+        raise ValueError(f"Server applied Content-Encoding to a ranged response for {url}")
+
+async def _download_ranges(client, url, f, start, total, validator_headers, hasher):
+    """
+    Fetches bytes [start, total) in parallel ranges and hashes them in order.
+    At most DOWNLOAD_RANGE_WORKERS ranges are in flight or buffered at a time.
+    """
+    async def fetch(offset, end):
+        headers = dict(validator_headers)
+        headers["Range"] = f"bytes={offset}-{end}"
+        headers["Accept-Encoding"] = "identity"
+        response = await client.get(url, headers=headers)
+        response.raise_for_status()
+        _check_identity_encoding(response, url)
+        if response.status_code != 206 or len(response.content) != end - offset + 1:
+            raise ValueError(f"Unexpected response for range {offset}-{end} of {url}")
+        return response.content
+
+    ranges = iter([(offset, min(offset + DOWNLOAD_RANGE_CHUNK, total) - 1)
+                   for offset in range(start, total, DOWNLOAD_RANGE_CHUNK)])
+    window = collections.deque()
+
+    def schedule_next():
+        next_range = next(ranges, None)
+        if next_range is not None:
+            window.append((next_range[0], asyncio.ensure_future(fetch(*next_range))))
+
+    for _ in range(max(1, DOWNLOAD_RANGE_WORKERS)):
+        schedule_next()
+    try:
+        while window:
+            offset, task = window.popleft()
+            data = await task
+            schedule_next()
+            f.seek(offset)
+            f.write(data)
+            hasher.update(data)
+    finally:
+        for _, task in window:
+            task.cancel()
+
+async def _fetch_to_file(client, url, filename, headers):
+    """
+    Downloads url into filename. Returns None on 304 Not Modified, otherwise
+    (sha256 hex digest, Content-Type, response headers).
+    """
+    headers = dict(headers)
+    # Ask for the first range only: servers without range support simply
+    # answer 200 with the full body, which is streamed as before.
+    headers["Range"] = f"bytes=0-{DOWNLOAD_RANGE_CHUNK - 1}"
+    headers["Accept-Encoding"] = "identity"
+    hasher = hashlib.sha256()
+    async with client.stream("GET", url, headers=headers) as response:
+        if response.status_code == 304 and ("If-None-Match" in headers or "If-Modified-Since" in headers):
+            return None
+        response.raise_for_status()
+        if response.status_code == 206:
+            _check_identity_encoding(response, url)
+            total = _parse_content_range_total(response.headers.get("Content-Range"))
+        else:
+            total = int(response.headers.get("Content-Length", 0)) or None
+        if total is not None:
+            _check_size(total, url)
+        size = 0
+        with open(filename, 'wb') as f:
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                _check_size(size, url)
+                hasher.update(chunk)
+                f.write(chunk)
+            if response.status_code == 206:
+                if total is None:
+                    raise ValueError(f"Server returned a partial response without a total size for {url}")
+                if size < total:
+                    # Pin the remaining ranges to the same version of the blob
+                    validator_headers = {}
+                    if response.headers.get("ETag"):
+                        validator_headers["If-Match"] = response.headers["ETag"]
+                    elif response.headers.get("Last-Modified"):
+                        validator_headers["If-Unmodified-Since"] = response.headers["Last-Modified"]
+                    await _download_ranges(client, url, f, size, total, validator_headers, hasher)
+        response_headers = response.headers
+    return hasher.hexdigest(), response_headers.get("Content-Type"), response_headers
 
 async def async_download_file(url, filename):
-    """Async file download using httpx.AsyncClient"""
-    async with httpx.AsyncClient(timeout=60) as client:
-        async with client.stream("GET", url) as response:
-            response.raise_for_status()
-            with open(filename, 'wb') as f:
-                async for chunk in response.aiter_bytes():
-                    f.write(chunk)
+    """
+    Async file download using the shared httpx.AsyncClient.
+    Revalidates against the local content cache with If-None-Match /
+    If-Modified-Since, and fetches large blobs that advertise range support
+    in parallel byte ranges. Enforces DOWNLOAD_MAX_BYTES and returns the
+    sha256 hex digest and Content-Type of the body.
+    """
+    client = get_async_client()
+    cached = _load_cache_entry(url)
+    result = await _fetch_to_file(client, url, filename, _conditional_headers(cached))
+    if result is None:
+        restored = _restore_cache_entry(url, filename, cached)
+        if restored is not None:
+            return restored
+        # The cached body failed verification: fetch it again unconditionally
+        result = await _fetch_to_file(client, url, filename, {})
+    digest, content_type, response_headers = result
+    _store_cache_entry(url, filename, response_headers, digest, content_type)
+    return digest, content_type
 
 # Extract text from PDF
 def extract_text_from_pdf(pdf_path):
@@ -53,32 +363,116 @@ def extract_text_from_eml(eml_path):
         parts.append(msg.get_content())
     return "\n".join(parts)
 
+# Extract text from plain text files
+def extract_text_from_txt(txt_path):
+    with open(txt_path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+# Content sniffers: each looks at the leading bytes of a file and says whether
+# it is of a given type. They never parse the whole file.
+SNIFF_BYTES = 4096
+RFC822_HEADER_PATTERN = re.compile(
+    rb"^(?:From|To|Cc|Subject|Date|Received|Return-Path|Message-ID|MIME-Version|Delivered-To|Reply-To|X-[A-Za-z0-9-]+):[ \t]",
+    re.IGNORECASE,
+)
+
+def sniff_pdf(head, file_path):
+    # Some producers put junk before the header; the spec tolerates 1 KB of it
+    return b"%PDF-" in head[:1024]
+
+def sniff_docx(head, file_path):
+    if not head.startswith(b"PK\x03\x04"):
+        return False
+    try:
+        with zipfile.ZipFile(file_path) as zf:
+            return "word/document.xml" in zf.namelist()
+    except zipfile.BadZipFile:
+        return False
+
+def sniff_eml(head, file_path):
+    lines = head.lstrip().splitlines()[:20]
+    return sum(1 for line in lines if RFC822_HEADER_PATTERN.match(line)) >= 2
+
+def sniff_text(head, file_path):
+    if not head or b"\x00" in head:
+        return False
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # Tolerate a multi-byte character cut off at the end of the sample
+        return e.start >= len(head) - 3 and e.reason == "unexpected end of data"
+    return True
+
+# Extractor registry: file type -> (extractor, sniffer, MIME types, extensions).
+# Register new formats with register_extractor; detection order is registration
+# order. Fallback entries only have their sniffer tried after every specific
+# sniffer, the Content-Type and the extension have failed to match.
+EXTRACTORS = {}
+
+def register_extractor(file_type, extractor, sniffer=None, mime_types=(), extensions=(), fallback=False):
+    """Registers an extractor for a file type, with how to recognise that type."""
+    EXTRACTORS[file_type] = {
+        "extractor": extractor,
+        "sniffer": sniffer,
+        "mime_types": {m.lower() for m in mime_types},
+        "extensions": {e.lower() for e in extensions},
+        "fallback": fallback,
+    }
+
+register_extractor('PDF', extract_text_from_pdf, sniff_pdf,
+                   mime_types=['application/pdf'], extensions=['.pdf'])
+register_extractor('DOCX', extract_text_from_docx, sniff_docx,
+                   mime_types=['application/vnd.openxmlformats-officedocument.wordprocessingml.document'],
+                   extensions=['.docx'])
+register_extractor('EML', extract_text_from_eml, sniff_eml,
+                   mime_types=['message/rfc822'], extensions=['.eml'])
+# Any NUL-free UTF-8 looks like text, so this must never beat a real match
+register_extractor('TEXT', extract_text_from_txt, sniff_text,
+                   mime_types=['text/plain'], extensions=['.txt'], fallback=True)
+
+def detect_file_type(file_path, content_type=None):
+    """
+    Detects the registered file type of a file: first from its leading bytes,
+    then from the response Content-Type, then from the file extension, and
+    finally with the fallback sniffers. Returns None if nothing matches.
+    """
+    with open(file_path, 'rb') as f:
+        head = f.read(SNIFF_BYTES)
+    for file_type, entry in EXTRACTORS.items():
+        if not entry["fallback"] and entry["sniffer"] and entry["sniffer"](head, file_path):
+            return file_type
+    mime = (content_type or "").split(";")[0].strip().lower()
+    for file_type, entry in EXTRACTORS.items():
+        if mime in entry["mime_types"]:
+            return file_type
+    guessed, _ = mimetypes.guess_type(file_path)
+    _, ext = os.path.splitext(file_path)
+    for file_type, entry in EXTRACTORS.items():
+        if ext.lower() in entry["extensions"] or (guessed and guessed in entry["mime_types"]):
+            return file_type
+    for file_type, entry in EXTRACTORS.items():
+        if entry["fallback"] and entry["sniffer"] and entry["sniffer"](head, file_path):
+            return file_type
+    return None
+
 # Main function to extract text based on file type
-def extract_text_from_file(file_path):
-    mime, _ = mimetypes.guess_type(file_path)
-    # Try by MIME type first
+def extract_text_from_file(file_path, content_type=None):
+    """
+    Detects the file type once and dispatches to the matching extractor.
+    content_type is the Content-Type the file was served with, if known.
+    """
+    file_type = detect_file_type(file_path, content_type)
+    if file_type is None:
+        guessed, _ = mimetypes.guess_type(file_path)
+        _, ext = os.path.splitext(file_path)
+        raise ValueError(
+            f"Unsupported file type for {file_path}: content-type={content_type!r}, "
+            f"extension={ext or None!r}, guessed mime={guessed!r}. Supported: {', '.join(EXTRACTORS)}"
+        )
     try:
-        if mime == 'application/pdf' or file_path.lower().endswith('.pdf'):
-            return extract_text_from_pdf(file_path)
-        elif mime == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document' or file_path.lower().endswith('.docx'):
-            return extract_text_from_docx(file_path)
-        elif mime == 'message/rfc822' or file_path.lower().endswith('.eml'):
-            return extract_text_from_eml(file_path)
+        return EXTRACTORS[file_type]["extractor"](file_path)
     except Exception as e:
-        pass  # Fallback to trying all formats below
-
-    # Fallback: try all supported formats in order
-    errors = []
-    for extractor, desc in [
-        (extract_text_from_pdf, 'PDF'),
-        (extract_text_from_docx, 'DOCX'),
-        (extract_text_from_eml, 'EML'),
-    ]:
-        try:
-            return extractor(file_path)
-        except Exception as e:
-            errors.append(f"{desc} extraction failed: {e}")
-    raise ValueError(f"Unsupported file type: {mime} for {file_path}. Tried all extractors. Errors: {' | '.join(errors)}")
+        raise ValueError(f"{file_type} extraction failed for {file_path}: {e}") from e
 
 # app/openai_utils.py
 import os
@@ -1,5 +1,5 @@
 # type: ignore
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from typing import List
@@ -7,16 +7,22 @@ import os
 import time
 import logging
 from dotenv import load_dotenv
-from app.file_utils import async_download_file, extract_text_from_file
+from app.file_utils import async_download_file, close_async_client, extract_text_from_file
 from app.openai_utils import ask_llm, get_embedding
-from app.clause_logic import match_clauses
+from app.clause_logic import match_clauses, rerank_chunks
 from app.contact_utils import is_contact_question, extract_contact_details
 from app.query_parser import parse_query
+from app.singleflight import SingleFlight
 from pinecone import Pinecone 
 from langchain.text_splitter import RecursiveCharacterTextSplitter 
 import gc
+import numpy as np
 import asyncio
 import urllib.parse
+import uuid
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 
@@ -27,6 +33,18 @@ logger = logging.getLogger("rag-app")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_INDEX_HOST = os.getenv("PINECONE_INDEX_HOST")
 PINECONE_NAMESPACE = os.getenv("PINECONE_NAMESPACE", "__default__")
+# Each request gets its own namespace "<prefix>-<created_at>-<uuid>" so concurrent
+# requests never see or overwrite each other's vectors. Expired namespaces are
+# dropped wholesale by the periodic garbage collector below.
+PINECONE_NAMESPACE_TTL = int(os.getenv("PINECONE_NAMESPACE_TTL", "900"))
+PINECONE_GC_INTERVAL = int(os.getenv("PINECONE_GC_INTERVAL", "300"))
+PINECONE_UPSERT_WORKERS = int(os.getenv("PINECONE_UPSERT_WORKERS", "4"))
+
+# Retrieved chunks are re-ranked with maximal marginal relevance down to
+# RERANK_TOP_N chunks (0 disables re-ranking); MMR_LAMBDA trades relevance
+# (1.0) against diversity (0.0).
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "5"))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
 
 # Initialize Pinecone and index
 pc = Pinecone(api_key=PINECONE_API_KEY)
@@ -53,66 +71,147 @@ def chunk_text_overlap(text, chunk_size=1200, overlap=200):
             seen.add(cleaned)
     return filtered_chunks
 
-def upsert_chunks_to_pinecone(chunks, batch_size=100):
+def new_request_namespace():
     """
-    Upsert chunks to Pinecone in batches. This is a simplified version.
+    Returns a fresh namespace for a single request. The creation time is encoded
+    in the name so any worker can tell when the namespace has expired.
     """
-    chunk_ids = []
-    # In a real-world app, you'd generate embeddings for the chunks here.
-    # For this example, let's assume we have a way to do that.
-    # The original file used get_embedding, which we'll keep.
-    try:
-        embeddings = get_embedding(chunks)
+    return f"{PINECONE_NAMESPACE}-{int(time.time())}-{uuid.uuid4().hex[:12]}"
+
+def namespace_created_at(namespace):
+    """
+    Returns the creation timestamp encoded in a request namespace, or None if
+    the namespace was not created by new_request_namespace.
+    """
+    prefix = f"{PINECONE_NAMESPACE}-"
+    if not namespace.startswith(prefix):
+        return None
+    created_at, _, suffix = namespace[len(prefix):].partition("-")
+    if not created_at.isdigit() or not suffix:
+        return None
+    return int(created_at)
+
+def upsert_chunks_to_pinecone(chunks, namespace, batch_size=100):
+    """
+    Embed and upsert chunks to Pinecone in batches, sending the batches in parallel.
+    Returns {chunk_id: float32 vector} for the chunks that were upserted successfully.
+    """
+    def upsert_batch(start):
+        batch = chunks[start:start + batch_size]
+        embeddings = get_embedding(batch)
         records = [{
-            "id": f"chunk-{i}", 
+            "id": f"chunk-{start + i}",
             "values": embedding,
             "metadata": {"chunk_text": chunk}
-        } for i, (chunk, embedding) in enumerate(zip(chunks, embeddings))]
-        
-        index.upsert(vectors=records, namespace=PINECONE_NAMESPACE)
-        chunk_ids = [record['id'] for record in records]
-        
-    except Exception as e:
-        logger.error(f"Pinecone upsert failed: {e}")
+        } for i, (chunk, embedding) in enumerate(zip(batch, embeddings))]
+        index.upsert(vectors=records, namespace=namespace)
+        return {record['id']: np.asarray(record['values'], dtype=np.float32) for record in records}
+
+    chunk_embeddings = {}
+    starts = range(0, len(chunks), batch_size)
+    with ThreadPoolExecutor(max_workers=max(1, PINECONE_UPSERT_WORKERS)) as executor:
+        futures = [executor.submit(upsert_batch, start) for start in starts]
+        for future in futures:
+            try:
+                chunk_embeddings.update(future.result())
+            except Exception as e:
+                logger.error(f"Pinecone upsert failed: {e}")
 
-    return chunk_ids
+    return chunk_embeddings
 
-def get_top_chunks(question, top_k=20):
+def get_chunk_embeddings(namespace, chunk_ids, chunk_embeddings=None):
     """
-    Hybrid retrieval: vector similarity + keyword search for improved recall.
+    Returns {chunk_id: vector} for chunk_ids, from the embeddings computed at
+    ingest when available and from Pinecone (index.fetch) for any that are missing.
+    """
+    chunk_embeddings = chunk_embeddings or {}
+    found = {chunk_id: chunk_embeddings[chunk_id] for chunk_id in chunk_ids if chunk_id in chunk_embeddings}
+    missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in found]
+    if missing:
+        try:
+            fetched = index.fetch(ids=missing, namespace=namespace)
+            for chunk_id, vector in (fetched.vectors or {}).items():
+                found[chunk_id] = np.asarray(vector.values, dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Fetching chunk embeddings failed: {e}")
+    return found
+
+def collect_expired_namespaces(ttl=PINECONE_NAMESPACE_TTL):
+    """
+    Drops every request namespace older than ttl seconds with a single
+    delete_all call per namespace. Returns the namespaces that were dropped.
+    """
+    stats = index.describe_index_stats()
+    namespaces = stats.get("namespaces", {}) or {}
+    now = time.time()
+    dropped = []
+    for namespace in namespaces:
+        created_at = namespace_created_at(namespace)
+        if created_at is None or now - created_at < ttl:
+            continue
+        try:
+            index.delete(delete_all=True, namespace=namespace)
+            dropped.append(namespace)
+        except Exception as e:
+            logger.warning(f"Failed to drop expired namespace {namespace}: {e}")
+    return dropped
+
+async def namespace_gc_loop():
+    """
+    Periodically drops expired request namespaces from the Pinecone index.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            dropped = await loop.run_in_executor(None, collect_expired_namespaces)
+            if dropped:
+                logger.info(f"Dropped {len(dropped)} expired namespaces from Pinecone index.")
+        except Exception as e:
+            logger.warning(f"Namespace garbage collection failed: {e}")
+        await asyncio.sleep(PINECONE_GC_INTERVAL)
+
+def get_top_chunks(question, namespace, parsed_query=None, top_k=20, top_n=None, chunk_embeddings=None):
+    """
+    Hybrid retrieval: vector similarity + keyword search for improved recall,
+    followed by MMR re-ranking (see clause_logic.rerank_chunks) down to top_n
+    diverse chunks. Returns a list of (chunk, score) pairs.
     """
     query_embedding = get_embedding(question)
     if isinstance(query_embedding, list) and len(query_embedding) == 1:
         query_embedding = query_embedding[0]
     # Dense vector search
     dense_results = index.query(
-        namespace=PINECONE_NAMESPACE,
+        namespace=namespace,
         vector=query_embedding,
         top_k=top_k,
         include_metadata=True,
         include_values=False
     )
-    dense_chunks = [match.get('metadata', {}).get('chunk_text', '')
-                    for match in dense_results.get('matches', [])]
+    chunk_ids = {}
+    dense_chunks = []
+    for match in dense_results.get('matches', []):
+        chunk = match.get('metadata', {}).get('chunk_text', '')
+        dense_chunks.append(chunk)
+        chunk_ids.setdefault(chunk.strip(), match.get('id'))
     # Keyword search over all chunks in the index (brute force for now)
     # For efficiency, you may want to cache all chunks or use a proper search engine
     keyword_chunks = []
     try:
         # Fetch all chunk texts in the namespace (simulate with a large top_k)
         all_results = index.query(
-            namespace=PINECONE_NAMESPACE,
+            namespace=namespace,
             vector=query_embedding,
             top_k=1000,
             include_metadata=True,
             include_values=False
         )
-        all_chunks = [match.get('metadata', {}).get('chunk_text', '')
-                      for match in all_results.get('matches', [])]
         question_words = set(question.lower().split())
-        for chunk in all_chunks:
+        for match in all_results.get('matches', []):
+            chunk = match.get('metadata', {}).get('chunk_text', '')
             chunk_words = set(chunk.lower().split())
             if question_words & chunk_words:
                 keyword_chunks.append(chunk)
+                chunk_ids.setdefault(chunk.strip(), match.get('id'))
     except Exception as e:
         logger.warning(f"Keyword search fallback failed: {e}")
     # Merge and deduplicate, prioritizing dense_chunks
@@ -125,12 +224,38 @@ def get_top_chunks(question, top_k=20):
             seen.add(cleaned)
         if len(merged) >= top_k:
             break
-    return merged
+    if top_n is None:
+        top_n = RERANK_TOP_N
+    if top_n <= 0:
+        return [(chunk, None) for chunk in merged]
+    # Re-rank with the embeddings computed at ingest; only the merged
+    # candidates' vectors are looked up.
+    vectors = get_chunk_embeddings(namespace, [chunk_ids[chunk] for chunk in merged], chunk_embeddings)
+    embeddings = [vectors.get(chunk_ids[chunk]) for chunk in merged]
+    if any(embedding is None for embedding in embeddings):
+        # Embeddings unavailable: keep retrieval order
+        return [(chunk, None) for chunk in merged]
+    return rerank_chunks(question, query_embedding, merged, embeddings, parsed_query,
+                         top_n=top_n, mmr_lambda=MMR_LAMBDA)
 
 app = FastAPI(title="Doc QA API - V4", description="API for document question answering using LLMs/embeddings.", root_path="/api/v1")
 security = HTTPBearer()
 BEARER_TOKEN = os.getenv("BEARER_TOKEN", "your-secure-token")
 
+@app.on_event("startup")
+async def start_namespace_gc():
+    app.state.namespace_gc_task = asyncio.create_task(namespace_gc_loop())
+
+@app.on_event("shutdown")
+async def stop_namespace_gc():
+    task = getattr(app.state, "namespace_gc_task", None)
+    if task:
+        task.cancel()
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await close_async_client()
+
 class QueryRequest(BaseModel):
     documents: str
     questions: List[str]
@@ -143,28 +268,37 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
     if credentials.scheme != "Bearer" or credentials.credentials != BEARER_TOKEN:
         raise HTTPException(status_code=401, detail="Invalid or missing token")
     
-@app.post("/hackrx/run", response_model=QueryResponse)
-@app.post("/hackrx/run/", response_model=QueryResponse)
-async def run_query(request: QueryRequest, background_tasks: BackgroundTasks, _: HTTPAuthorizationCredentials = Depends(verify_token)):
+# In-flight document ingests and LLM calls, shared by concurrent requests
+ingest_flight = SingleFlight()
+llm_flight = SingleFlight()
 
+async def ingest_document(file_url):
+    """
+    Downloads, extracts, chunks and upserts a document into a fresh request
+    namespace. Returns the namespace, the contact hint for the document and
+    the chunk embeddings computed at ingest ({chunk_id: vector}). The embeddings
+    live only as long as the requests sharing this ingest.
+    """
     # Step 1: Download and extract text from file
-    file_url = request.documents
     parsed_url = urllib.parse.urlparse(file_url)
     file_name_from_url = os.path.basename(parsed_url.path)
+    # The extension is only a hint; the file type is sniffed from its content
     _, ext = os.path.splitext(file_name_from_url)
-    if not ext:
-        ext = '.pdf' # Assume PDF if no extension is found
-    local_file = f"temp_downloaded_file{ext}"
+    fd, local_file = tempfile.mkstemp(prefix="temp_downloaded_file", suffix=ext)
+    os.close(fd)
     t0 = time.time()
     try:
         logger.info(f"Downloading file from {file_url} (async)")
-        await async_download_file(file_url, local_file)
+        digest, content_type = await async_download_file(file_url, local_file)
+        logger.info(f"Downloaded file sha256={digest} content_type={content_type}")
         logger.info(f"Extracting text from {local_file}")
-        text = extract_text_from_file(local_file)
+        text = extract_text_from_file(local_file, content_type)
         logger.info(f"Extracted {len(text)} characters from file")
     except Exception as e:
         logger.error(f"File extraction failed: {e}")
         raise HTTPException(status_code=400, detail=f"File extraction failed: {e}")
+    finally:
+        os.remove(local_file)
     t1 = time.time()
     logger.info(f"File download and extraction took {t1-t0:.2f} seconds")
     
@@ -188,11 +322,25 @@ async def run_query(request: QueryRequest, background_tasks: BackgroundTasks, _:
     logger.info(f"Chunking took {t3-t2:.2f} seconds")
 
     t4 = time.time()
-    logger.info("Upserting chunk texts to Pinecone index")
-    chunk_ids = upsert_chunks_to_pinecone(chunks)
+    namespace = new_request_namespace()
+    logger.info(f"Upserting chunk texts to Pinecone namespace {namespace}")
+    chunk_embeddings = await asyncio.get_running_loop().run_in_executor(None, upsert_chunks_to_pinecone, chunks, namespace)
+    logger.info(f"Upserted {len(chunk_embeddings)}/{len(chunks)} chunks")
     t5 = time.time()
     logger.info(f"Pinecone upsert took {t5-t4:.2f} seconds")
     
+    return namespace, all_contact_hint, chunk_embeddings
+
+@app.post("/hackrx/run", response_model=QueryResponse)
+@app.post("/hackrx/run/", response_model=QueryResponse)
+async def run_query(request: QueryRequest, _: HTTPAuthorizationCredentials = Depends(verify_token)):
+
+    # Step 1 & 2: Download, extract, chunk and upsert the document. Concurrent
+    # requests for the same document share a single ingest.
+    file_url = request.documents
+    document_key = hashlib.sha256(file_url.encode("utf-8")).hexdigest()
+    namespace, all_contact_hint, chunk_embeddings = await ingest_flight.do(document_key, lambda: ingest_document(file_url))
+
     # Semaphore to limit concurrency for LLM calls
     semaphore = asyncio.Semaphore(10)
 
@@ -234,9 +382,12 @@ async def run_query(request: QueryRequest, background_tasks: BackgroundTasks, _:
     # Reduce top_k for faster retrieval
     top_k = int(os.getenv("RETRIEVAL_TOP_K", "10"))
     retrieval_start = time.time()
-    all_top_chunks = await loop.run_in_executor(None, lambda: [get_top_chunks(q, top_k) for q in request.questions])
+    all_top_chunks = await loop.run_in_executor(None, lambda: [get_top_chunks(q, namespace, parsed_queries[i], top_k, chunk_embeddings=chunk_embeddings) for i, q in enumerate(request.questions)])
     retrieval_end = time.time()
     logger.info(f"Chunk retrieval for all questions took {retrieval_end - retrieval_start:.2f} seconds")
+    for idx, top_chunks in enumerate(all_top_chunks):
+        scores = ", ".join("-" if score is None else f"{score:.3f}" for _, score in top_chunks)
+        logger.info(f"Question {idx+1}: {len(top_chunks)} context chunks (scores: {scores})")
 
     async def process_question_with_chunks(idx, question, parsed_query, top_chunks):
         async with semaphore:
@@ -247,15 +398,19 @@ async def run_query(request: QueryRequest, background_tasks: BackgroundTasks, _:
             if all_contact_hint:
                 prompt_context_parts.append(f"CONTACTS AND ADDRESSES IN THE DOCUMENT: {all_contact_hint}")
             prompt_context_parts.append(f"PARSED QUERY FIELDS: {parsed_query}")
-            prompt_context_parts.append("\n\nRELEVANT DOCUMENT CHUNKS:\n" + "\n".join(top_chunks))
+            prompt_context_parts.append("\n\nRELEVANT DOCUMENT CHUNKS:\n" + "\n".join(chunk for chunk, _ in top_chunks))
             final_context = "\n".join(prompt_context_parts)
             prompt = (
                 f"Question: {question}\nContext: {final_context}"
             )
             llm_start = time.time()
             try:
-                # Add a timeout for the LLM call (e.g., 30 seconds)
-                answer = await asyncio.wait_for(loop.run_in_executor(None, ask_llm, prompt), timeout=30)
+                # Add a timeout for the LLM call (e.g., 30 seconds). Only
+                # in-flight calls with the identical prompt share one completion.
+                answer = await llm_flight.do(
+                    hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+                    lambda: asyncio.wait_for(loop.run_in_executor(None, ask_llm, prompt), timeout=30)
+                )
                 logger.info("LLM answer generated successfully")
             except asyncio.TimeoutError:
                 logger.error(f"LLM call timed out for question {idx+1}")
@@ -277,16 +432,8 @@ async def run_query(request: QueryRequest, background_tasks: BackgroundTasks, _:
     ])
     logger.info(f"Returning {len(answers)} answers to client")
 
-    # Cleanup: delete the upserted chunks from Pinecone in the background
-    def cleanup_chunks(chunk_ids):
-        try:
-            if chunk_ids:
-                logger.info(f"Cleaning up {len(chunk_ids)} chunks from Pinecone index.")
-                index.delete(ids=chunk_ids, namespace=PINECONE_NAMESPACE)
-        except Exception as e:
-            logger.warning(f"Cleanup failed: {e}")
-
-    background_tasks.add_task(cleanup_chunks, chunk_ids)
+    # No per-request delete: the namespace is dropped by namespace_gc_loop
+    # once it is older than PINECONE_NAMESPACE_TTL.
 
     return QueryResponse(answers=answers)
 
@@ -0,0 +1,50 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into a single unit of work.
+    The first caller starts the work; later callers with the same key await the
+    same result (or exception) instead of repeating it. The key is forgotten as
+    soon as the work finishes, so failures are never cached.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[Hashable, int] = {}
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            self._waiters.pop(key, None)
+        # Mark the exception as retrieved in case every waiter was cancelled.
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Runs fn() once for all concurrent callers with the same key.
+        A cancelled caller only stops waiting; the shared work is cancelled
+        only when no callers are left waiting for it.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(fn())
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t: self._forget(key, t))
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._inflight.get(key) is task:
+                self._waiters[key] -= 1
+                if self._waiters[key] == 0:
+                    # Forget the key first so a caller arriving while the
+                    # task unwinds starts fresh work instead of inheriting
+                    # the cancellation.
+                    del self._inflight[key]
+                    del self._waiters[key]
+                    task.cancel()
+            raise